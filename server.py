@@ -1,90 +1,326 @@
 import os
+import math
+import re
+import asyncio
+import hashlib
+import io
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import sqlite3
+import threading
+import time
 from pathlib import Path
-import io, csv
-import requests
-from fastapi import FastAPI, UploadFile, File
+import httpx
+import orjson
+from fastapi import FastAPI, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from PIL import Image, ImageOps
 
 # ------------------ Roboflow (Object Detection) ------------------
 ROBOFLOW_API_KEY = os.getenv("ROBOFLOW_API_KEY", "")
 PROJECT = os.getenv("RF_PROJECT", "fresh-or-rotten-detection-1yxeg").strip()
 VERSION = os.getenv("RF_VERSION", "1").strip()
+RF_HOST = os.getenv("RF_HOST", "https://detect.roboflow.com").strip().rstrip("/")
 # Detect (object detection) endpoint:
-DETECT_URL = f"https://detect.roboflow.com/{PROJECT}/{VERSION}"
-
-if not ROBOFLOW_API_KEY:
-    raise RuntimeError("Missing ROBOFLOW_API_KEY environment variable.")
+DETECT_URL = f"{RF_HOST}/{PROJECT}/{VERSION}"
+
+# Constant request bits for every Detect call (path is relative to RF_HOST)
+_RF_PATH = f"/{PROJECT}/{VERSION}"
+# Pass API key as query param (this is the most reliable path with Detect)
+_RF_PARAMS = {
+    "api_key": ROBOFLOW_API_KEY,
+    # Optional tuning (uncomment to use):
+    # "confidence": 0.5,
+    # "overlap": 0.3,
+    # "format": "json",
+}
+_RF_HEADERS = {"Accept": "application/json"}
 
 # ------------------ FastAPI + CORS ------------------
-app = FastAPI(title="Fruit & Gas Cloud API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in every worker process, so a bad deploy fails at boot
+    if not ROBOFLOW_API_KEY:
+        raise RuntimeError("Missing ROBOFLOW_API_KEY environment variable.")
+    # The pieces below are defined in their own sections further down
+    open_rf_client()
+    init_db()
+    init_updates()
+    start_db_writer()
+    try:
+        yield
+    finally:
+        await stop_db_writer()
+        close_db()
+        await app.state.rf_client.aclose()
+
+app = FastAPI(title="Fruit & Gas Cloud API", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Comma-separated origins allowed to call the API from a browser. No
+# cookies/auth are used, so credentials stay off (which "*" requires), and
+# browsers may cache the preflight for a day.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
+    max_age=86400,
 )
 
+class _GZipExceptEvents(GZipMiddleware):
+    """GZip for everything but /events: the gzip stream would hold SSE frames back."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/events":
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+app.add_middleware(_GZipExceptEvents, minimum_size=512)
+
+# ------------------ Roboflow HTTP client ------------------
+# Shared async client: /predict awaits Roboflow without blocking the event
+# loop, and keep-alive/HTTP2 connections are reused across requests.
+# The transport retries connection failures.
+RF_MAX_CONNECTIONS = int(os.getenv("RF_MAX_CONNECTIONS", "64"))
+RF_MAX_KEEPALIVE = int(os.getenv("RF_MAX_KEEPALIVE", "32"))
+# Keep idle connections (one HTTP/2 connection multiplexes concurrent
+# uploads) well past httpx's 5 s default so sporadic /predict calls reuse them
+RF_KEEPALIVE_EXPIRY = float(os.getenv("RF_KEEPALIVE_EXPIRY", "60"))
+# Cap on concurrent Detect calls per worker (size it to the Roboflow quota).
+# Callers wait up to RF_QUEUE_TIMEOUT seconds for a slot, then get a 503.
+# /predict/raw holds its slot while the client is still uploading, so it
+# draws from a separate, smaller pool and slow uploaders cannot starve
+# /predict and /batch.
+RF_MAX_INFLIGHT = int(os.getenv("RF_MAX_INFLIGHT", "16"))
+RF_RAW_MAX_INFLIGHT = int(os.getenv("RF_RAW_MAX_INFLIGHT", "4"))
+RF_QUEUE_TIMEOUT = float(os.getenv("RF_QUEUE_TIMEOUT", "10"))
+
+def open_rf_client():
+    # Created per startup: asyncio primitives bind to the loop they first wait on
+    app.state.rf_sem = asyncio.Semaphore(RF_MAX_INFLIGHT)
+    app.state.rf_raw_sem = asyncio.Semaphore(RF_RAW_MAX_INFLIGHT)
+    app.state.rf_client = httpx.AsyncClient(
+        base_url=RF_HOST,
+        timeout=60,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(
+                max_connections=RF_MAX_CONNECTIONS,
+                max_keepalive_connections=RF_MAX_KEEPALIVE,
+                keepalive_expiry=RF_KEEPALIVE_EXPIRY,
+            ),
+        ),
+    )
+
 # ------------------ In-memory cache ------------------
+# Per worker process: with several workers, /summary and /events only
+# reflect the /gas and /predict calls that reached the same process.
 LAST = {
     "vision": None,
+    "vision_top": None,  # extract_top_detection(vision), computed once per /predict
     "vision_updated": None,
     "gas": None,
     "gas_updated": None,
+    "history_updated": None,  # ts of the newest row this worker has committed
 }
 
 # ------------------ SQLite for gas history ------------------
 DB_PATH = Path("data.db")
 
+# Timestamps are stored as integer unix microseconds (UTC) and only
+# formatted as ISO strings when they leave the API.
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+
+def _now_us() -> int:
+    return time.time_ns() // 1000
+
+def _ts_iso(ts_us: int) -> str:
+    return (_EPOCH + timedelta(microseconds=ts_us)).isoformat()
+
+def _iso_to_us(ts: str) -> int:
+    return (datetime.fromisoformat(ts) - _EPOCH) // _ONE_US
+
+# Per-connection tuning: WAL only fsyncs the log on commit, and readers
+# (/history, /export.csv) no longer block the /gas writer.
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-10000",
+)
+
+def _connect():
+    # Autocommit mode: write transactions are opened explicitly under WRITE_LOCK
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    for pragma in _CONNECTION_PRAGMAS:
+        con.execute(pragma)
+    return con
+
+# Statement text is fixed so sqlite3's per-connection statement cache
+# reuses the compiled statements on the shared connection below.
+_INSERT_SQL = "INSERT INTO gas_readings (ts, co2, nh3, benzene, alcohol) VALUES (?, ?, ?, ?, ?)"
+_SELECT_SQL = "SELECT ts, co2, nh3, benzene, alcohol FROM gas_readings WHERE ts >= ? ORDER BY ts ASC"
+
+# One connection shared by the request threadpool, opened by init_db() at
+# startup and closed by close_db() at shutdown
+CON = None
+WRITE_LOCK = threading.Lock()
+
+_CREATE_SQL = """
+    CREATE TABLE IF NOT EXISTS gas_readings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER NOT NULL,
+        co2 REAL, nh3 REAL, benzene REAL, alcohol REAL
+    )
+"""
+
 def init_db():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS gas_readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT NOT NULL,
-            co2 REAL, nh3 REAL, benzene REAL, alcohol REAL
-        )
-    """)
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_gas_ts ON gas_readings(ts)")
-    con.commit()
-    con.close()
-
-def save_reading(ppm: dict):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO gas_readings (ts, co2, nh3, benzene, alcohol) VALUES (?, ?, ?, ?, ?)",
-        (datetime.utcnow().isoformat(),
-         ppm.get("co2"), ppm.get("nh3"),
-         ppm.get("benzene"), ppm.get("alcohol"))
+    global CON
+    CON = _connect()
+    # Only takes effect on a new database file; lets /cron/prune hand freed
+    # pages back to the filesystem without a full VACUUM
+    CON.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # journal_mode is persistent for the database file, so once is enough
+    CON.execute("PRAGMA journal_mode=WAL")
+    CON.execute(_CREATE_SQL)
+    if _ts_column_type() == "TEXT":
+        _migrate_text_timestamps()
+    # Covering index: the history range scan never has to visit the table
+    CON.execute("DROP INDEX IF EXISTS idx_gas_ts")
+    CON.execute(
+        "CREATE INDEX IF NOT EXISTS idx_gas_ts_cover "
+        "ON gas_readings(ts, co2, nh3, benzene, alcohol)"
     )
-    con.commit()
-    con.close()
-
-def load_history_last_days(days: int = 2):
-    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
-        SELECT ts, co2, nh3, benzene, alcohol
-        FROM gas_readings
-        WHERE ts >= ?
-        ORDER BY ts ASC
-    """, (cutoff,))
-    rows = cur.fetchall()
-    con.close()
+
+def _ts_column_type() -> str:
+    return {row[1]: row[2] for row in CON.execute("PRAGMA table_info(gas_readings)")}["ts"]
+
+def _migrate_text_timestamps():
+    """Rewrite a database created with ISO-string ts into the integer schema."""
+    with WRITE_LOCK, CON:
+        # Take the write lock up front: every worker runs init_db() at boot,
+        # and another one may have migrated while this one was waiting
+        CON.execute("BEGIN IMMEDIATE")
+        if _ts_column_type() != "TEXT":
+            return
+        rows = CON.execute("SELECT id, ts, co2, nh3, benzene, alcohol FROM gas_readings").fetchall()
+        CON.execute("DROP TABLE gas_readings")
+        CON.execute(_CREATE_SQL)
+        CON.executemany(
+            "INSERT INTO gas_readings (id, ts, co2, nh3, benzene, alcohol) VALUES (?, ?, ?, ?, ?, ?)",
+            [(id_, _iso_to_us(ts), *ppm) for (id_, ts, *ppm) in rows]
+        )
+
+def _insert_rows(rows: list[tuple]):
+    """Insert (ts, co2, nh3, benzene, alcohol) rows in one transaction."""
+    # The connection context manager commits, or rolls back on error
+    with WRITE_LOCK, CON:
+        CON.execute("BEGIN")
+        CON.executemany(_INSERT_SQL, rows)
+
+# Readings are queued (one list of rows per save_readings() call) and
+# written by one background task. Each transaction takes queued lists until
+# it holds WRITE_BATCH_MAX rows, but never splits a list, so one call's
+# readings commit atomically. A reading is durable once its transaction
+# commits; the queue is flushed on shutdown.
+WRITE_BATCH_MAX = 200
+
+async def _db_writer(queue: asyncio.Queue):
+    while True:
+        rows, item = [], await queue.get()
+        while item is not None:
+            rows.extend(item)
+            if len(rows) >= WRITE_BATCH_MAX or queue.empty():
+                break
+            item = queue.get_nowait()
+        if rows:
+            try:
+                await run_in_threadpool(_insert_rows, rows)
+            except sqlite3.Error as e:
+                print("Gas DB write failed:", repr(e), "- dropped", len(rows), "rows")
+            else:
+                # /events tells the UI to fetch the rows now that they are readable
+                LAST["history_updated"] = max(row[0] for row in rows)
+                notify_update()
+        if item is None:  # shutdown sentinel
+            return
+
+def start_db_writer():
+    app.state.write_q = asyncio.Queue()
+    app.state.db_writer = asyncio.create_task(_db_writer(app.state.write_q))
+
+async def stop_db_writer():
+    await app.state.write_q.put(None)
+    await app.state.db_writer
+
+def save_readings(ppms: list[dict], ts: int | None = None):
+    """
+    Queue readings (oldest first) for the background writer; call from the
+    event loop. The last one is stamped `ts` and each earlier one a
+    microsecond before the next, so history keeps their order.
+    """
+    first = (ts or _now_us()) - len(ppms) + 1
+    app.state.write_q.put_nowait([
+        (first + i, ppm.get("co2"), ppm.get("nh3"), ppm.get("benzene"), ppm.get("alcohol"))
+        for i, ppm in enumerate(ppms)
+    ])
+
+def save_reading(ppm: dict, ts: int | None = None):
+    save_readings([ppm], ts)
+
+def _history_cursor(days: int, after: int | None = None):
+    cutoff = _now_us() - days * 86_400_000_000
+    if after is not None:
+        cutoff = max(cutoff, after + 1)
+    return CON.execute(_SELECT_SQL, (cutoff,))
+
+def prune_readings(days: int) -> int:
+    """Delete readings older than `days`; returns the number of rows removed."""
+    cutoff = _now_us() - days * 86_400_000_000
+    with WRITE_LOCK:
+        with CON:
+            CON.execute("BEGIN")
+            deleted = CON.execute("DELETE FROM gas_readings WHERE ts < ?", (cutoff,)).rowcount
+        if deleted and CON.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            # execute() would only step it once (one page); a script runs it to completion
+            CON.executescript("PRAGMA incremental_vacuum;")
+    return deleted
+
+def history_bounds(days: int) -> tuple:
+    """
+    (oldest, newest) ts within the last `days`, or (None, None) when empty.
+    Two subqueries, so each is a single index lookup.
+    """
+    cutoff = _now_us() - days * 86_400_000_000
+    return CON.execute(
+        "SELECT (SELECT MIN(ts) FROM gas_readings WHERE ts >= ?), (SELECT MAX(ts) FROM gas_readings)",
+        (cutoff,),
+    ).fetchone()
+
+def load_history_last_days(days: int = 2, after: int | None = None):
+    rows = _history_cursor(days, after).fetchall()
     return [
-        {"time": ts, "ppm": {"co2": co2, "nh3": nh3, "benzene": benz, "alcohol": alc}}
+        {"time": _ts_iso(ts), "ppm": {"co2": co2, "nh3": nh3, "benzene": benz, "alcohol": alc}}
         for (ts, co2, nh3, benz, alc) in rows
     ]
 
-init_db()
+def close_db():
+    # Refresh query planner stats gathered during this process' lifetime
+    with WRITE_LOCK:
+        CON.execute("PRAGMA optimize")
+        CON.close()
 
 # ------------------ Vision helpers (Object Detection) ------------------
 def extract_top_detection(resp_obj):
@@ -99,61 +335,247 @@ def extract_top_detection(resp_obj):
     preds = resp_obj.get("predictions") or []
     if not isinstance(preds, list) or not preds:
         return None
-    top = max(preds, key=lambda p: float(p.get("confidence", 0.0)))
-    label = str(top.get("class", "?"))
-    conf = float(top.get("confidence", 0.0)) * 100.0
-    return {"label": label, "confidence": round(conf, 1)}
+    # Single pass, one confidence lookup per box
+    top, top_conf = None, -1.0
+    for p in preds:
+        conf = float(p.get("confidence") or 0.0)
+        if conf > top_conf:
+            top, top_conf = p, conf
+    return {"label": str(top.get("class", "?")), "confidence": round(top_conf * 100.0, 1)}
 
 # ------------------ /predict (Detect) ------------------
-@app.post("/predict")
-async def predict(image: UploadFile = File(...)):
-    data = await image.read()
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Longest side the model needs; bigger uploads are shrunk before forwarding
+RF_MAX_SIDE = int(os.getenv("RF_MAX_SIDE", "640"))
+# Largest image decoded for shrinking (16 MP is ~64 MB as RGBA). A small,
+# highly compressed PNG can still decode to hundreds of MB, so bigger
+# images are forwarded as-is rather than decoded here.
+SHRINK_MAX_PIXELS = int(os.getenv("SHRINK_MAX_PIXELS", str(16_000_000)))
+
+def _shrink_image(f) -> bytes | None:
+    """
+    Re-encode an image larger than RF_MAX_SIDE as a JPEG (quality 85) that
+    fits in RF_MAX_SIDE x RF_MAX_SIDE. Returns None when the upload is small
+    enough, too large to decode safely or not decodable, in which case the
+    original is forwarded as-is.
+    """
     try:
-        files = {"file": ("image.jpg", data, image.content_type or "image/jpeg")}
-        # Pass API key as query param (this is the most reliable path with Detect)
-        params = {
-            "api_key": ROBOFLOW_API_KEY,
-            # Optional tuning (uncomment to use):
-            # "confidence": 0.5,
-            # "overlap": 0.3,
-            # "format": "json",
-        }
-        resp = requests.post(DETECT_URL, params=params, files=files, timeout=60)
+        img = Image.open(f)  # reads the header only
+        if max(img.size) <= RF_MAX_SIDE:
+            return None
+        # For JPEGs, let the decoder downscale by 1/2..1/8 while decoding
+        img.draft("RGB", (RF_MAX_SIDE, RF_MAX_SIDE))
+        if img.size[0] * img.size[1] > SHRINK_MAX_PIXELS:
+            return None
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((RF_MAX_SIDE, RF_MAX_SIDE))
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+        return buf.getvalue()
+    except (OSError, Image.DecompressionBombError):
+        return None
+    finally:
+        f.seek(0)
+
+async def _post_roboflow(
+    headers: dict = _RF_HEADERS, sem: asyncio.Semaphore | None = None, **request
+) -> tuple[dict, int]:
+    """
+    POST one image to Roboflow Detect; `request` is the httpx body (files=
+    or content=) and `sem` the slot pool (app.state.rf_sem by default).
+    Returns (payload, status): the Roboflow JSON with 200, or an error body
+    with the HTTP status to report.
+    """
+    sem = sem or app.state.rf_sem
+    try:
+        await asyncio.wait_for(sem.acquire(), RF_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return {"error": "roboflow_busy", "detail": "Too many detections in progress; retry shortly."}, 503
+    try:
+        resp = await app.state.rf_client.post(_RF_PATH, params=_RF_PARAMS, headers=headers, **request)
 
         # Helpful debugging in Render logs
         if resp.status_code >= 400:
             print("Roboflow error:", resp.status_code, resp.text[:500])
 
         if resp.status_code == 403:
-            return JSONResponse(
-                {
-                    "error": "roboflow_403",
-                    "detail": "Forbidden (403). Check API key / model path / Hosted API deploy.",
-                    "endpoint": resp.url,
-                },
-                status_code=502,
-            )
+            return {
+                "error": "roboflow_403",
+                "detail": "Forbidden (403). Check API key / model path / Hosted API deploy.",
+                "endpoint": str(resp.url),
+            }, 502
 
         resp.raise_for_status()
-        j = resp.json()
+        # Decode off the event loop; detection payloads can be large
+        return await run_in_threadpool(orjson.loads, resp.content), 200
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         # Print to logs so you can see the exact reason in Render
         print("Roboflow request exception:", repr(e))
-        return JSONResponse(
-            {"error": "roboflow_request_failed", "detail": str(e), "endpoint": DETECT_URL},
-            status_code=502,
-        )
+        return {"error": "roboflow_request_failed", "detail": str(e), "endpoint": DETECT_URL}, 502
     except ValueError:
         print("Roboflow non-JSON response:", resp.text[:500])
-        return JSONResponse(
-            {"error": "roboflow_non_json", "detail": resp.text[:500], "endpoint": DETECT_URL},
-            status_code=502,
+        return {"error": "roboflow_non_json", "detail": resp.text[:500], "endpoint": DETECT_URL}, 502
+    finally:
+        sem.release()
+
+async def _call_roboflow(image: UploadFile) -> tuple[dict, int]:
+    """POST one upload to Roboflow Detect, shrinking it first if it is large."""
+    shrunk = await run_in_threadpool(_shrink_image, image.file)
+    if shrunk is not None:
+        files = {"file": ("image.jpg", shrunk, "image/jpeg")}
+    else:
+        # Stream from the spooled upload instead of copying it into memory
+        files = {"file": ("image.jpg", image.file, image.content_type or "image/jpeg")}
+    return await _post_roboflow(files=files)
+
+# ------------------ Prediction cache ------------------
+# Successful results keyed by a hash of the upload bytes, so retried or
+# repeated images skip Roboflow. Identical uploads already in flight wait
+# for that call instead of starting their own.
+PREDICT_CACHE_SIZE = int(os.getenv("PREDICT_CACHE_SIZE", "256"))
+PREDICT_CACHE_TTL = float(os.getenv("PREDICT_CACHE_TTL", "600"))
+_PREDICT_CACHE: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+_PREDICT_INFLIGHT: dict[str, asyncio.Task] = {}
+
+def _cache_get(key: str) -> dict | None:
+    hit = _PREDICT_CACHE.get(key)
+    if hit is None:
+        return None
+    expires, payload = hit
+    if expires < time.monotonic():
+        del _PREDICT_CACHE[key]
+        return None
+    _PREDICT_CACHE.move_to_end(key)
+    return payload
+
+def _cache_put(key: str, payload: dict):
+    _PREDICT_CACHE[key] = (time.monotonic() + PREDICT_CACHE_TTL, payload)
+    _PREDICT_CACHE.move_to_end(key)
+    while len(_PREDICT_CACHE) > PREDICT_CACHE_SIZE:
+        _PREDICT_CACHE.popitem(last=False)
+
+async def _hash_upload(image: UploadFile) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    while chunk := await image.read(65536):
+        h.update(chunk)
+    await image.seek(0)
+    return h.hexdigest()
+
+async def _detect(image: UploadFile) -> tuple[dict, int]:
+    """
+    Run one upload through Roboflow Detect (or the cache) and close it.
+    Returns (payload, status) as _call_roboflow does.
+    """
+    try:
+        if (image.size or 0) > MAX_UPLOAD_BYTES:
+            return {"error": "image_too_large", "detail": f"Upload exceeds {MAX_UPLOAD_BYTES} bytes."}, 413
+
+        key = await _hash_upload(image)
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached, 200
+        # Join an identical call in flight; if it got cancelled, make our own
+        while (task := _PREDICT_INFLIGHT.get(key)) is not None:
+            await asyncio.wait({task})
+            if not task.cancelled():
+                return task.result()
+
+        task = asyncio.create_task(_call_roboflow(image))
+        _PREDICT_INFLIGHT[key] = task
+        try:
+            payload, status = await task
+        finally:
+            del _PREDICT_INFLIGHT[key]
+        if status == 200:
+            _cache_put(key, payload)
+        return payload, status
+    finally:
+        await image.close()
+
+async def _set_vision(j: dict):
+    top = await run_in_threadpool(extract_top_detection, j)
+    LAST["vision"] = j
+    LAST["vision_top"] = top
+    LAST["vision_updated"] = _now_us()
+    notify_update()
+
+@app.post("/predict")
+async def predict(image: UploadFile = File(...)):
+    j, status = await _detect(image)
+    if status == 200:
+        await _set_vision(j)
+    return ORJSONResponse(j, status_code=status)
+
+# ------------------ /predict/raw (streamed) ------------------
+# The body is the image itself (Content-Type: image/*). It is relayed to
+# Roboflow as it arrives, so receiving the upload and sending it upstream
+# overlap. Nothing is buffered, so there is no resize and no cache here.
+_IMAGE_TYPE_RE = re.compile(r"image/[\w.+-]+")
+
+class _UploadTooLarge(Exception):
+    pass
+
+async def _multipart_relay(request: Request, boundary: str, content_type: str):
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="image.jpg"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > MAX_UPLOAD_BYTES:
+            raise _UploadTooLarge
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+@app.post("/predict/raw")
+async def predict_raw(request: Request):
+    too_large = ORJSONResponse(
+        {"error": "image_too_large", "detail": f"Upload exceeds {MAX_UPLOAD_BYTES} bytes."},
+        status_code=413,
+    )
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > MAX_UPLOAD_BYTES:
+        return too_large
+
+    m = _IMAGE_TYPE_RE.fullmatch(request.headers.get("content-type", "").split(";")[0].strip())
+    content_type = m.group(0) if m else "image/jpeg"
+    boundary = os.urandom(16).hex()
+    try:
+        j, status = await _post_roboflow(
+            headers={**_RF_HEADERS, "Content-Type": f"multipart/form-data; boundary={boundary}"},
+            sem=app.state.rf_raw_sem,
+            content=_multipart_relay(request, boundary, content_type),
         )
+    except _UploadTooLarge:
+        return too_large
+    if status == 200:
+        await _set_vision(j)
+    return ORJSONResponse(j, status_code=status)
 
-    LAST["vision"] = j
-    LAST["vision_updated"] = datetime.utcnow().isoformat()
-    return JSONResponse(j)
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "8"))
+
+@app.post("/batch")
+async def predict_batch(images: list[UploadFile] = File(...)):
+    """
+    Detect several images in one call. The hosted Detect API takes one image
+    per request, so the uploads are sent concurrently over the shared
+    client. Each result is the Roboflow JSON or an error body, in order.
+    """
+    if len(images) > MAX_BATCH_IMAGES:
+        for image in images:
+            await image.close()
+        return ORJSONResponse(
+            {"error": "too_many_images", "detail": f"Send at most {MAX_BATCH_IMAGES} images."},
+            status_code=413,
+        )
+    results = await asyncio.gather(*(_detect(image) for image in images))
+    ok = [j for j, status in results if status == 200]
+    if ok:
+        await _set_vision(ok[-1])
+    return {"results": [j for j, _ in results]}
 
 
 # ------------------ Gas model ------------------
@@ -166,16 +588,25 @@ class GasReading(BaseModel):
     rs:   float | None = None
     r0:   float | None = None
 
-def _ppm_from_ratio(ratio: float, a: float, b: float) -> float:
+# MQ-135 curves ppm = a * ratio**b, stored as (gas, log(a), b) so one
+# log(ratio) serves all gases: ppm = exp(log(a) + b * log(ratio))
+_PPM_CURVES = (
+    ("co2",     math.log(116.6021), -2.7690),
+    ("nh3",     math.log(102.6940), -2.4880),
+    ("benzene", math.log(76.63),    -2.1680),
+    ("alcohol", math.log(77.255),   -3.18),
+)
+
+def _ppm_from_ratio(ratio: float) -> dict:
     if ratio is None or ratio <= 0:
-        return 0.0
-    return max(0.0, a * (ratio ** b))
+        return {gas: 0.0 for gas, _, _ in _PPM_CURVES}
+    log_ratio = math.log(ratio)
+    return {gas: round(math.exp(log_a + b * log_ratio), 1) for gas, log_a, b in _PPM_CURVES}
 
-@app.post("/gas")
-def gas(g: GasReading):
+def _compute_gas(g: GasReading):
     """
-    Accept gas info from ESP32/UNO (or the manual UI),
-    compute Rs/ratio/ppm, update LAST, and persist to DB.
+    Compute Rs/ratio/ppm for one reading.
+    Returns the data dict, or None when neither vrl, adc nor rs was sent.
     """
     VREF = float(g.vref or 3.3)
     RL   = float(g.rl or 10000.0)
@@ -185,44 +616,104 @@ def gas(g: GasReading):
         g.vrl = (float(g.adc) / float(adc_max)) * VREF
 
     if g.vrl is None and g.rs is None:
-        return {"error": "Send at least one of: vrl, adc, or rs."}
+        return None
 
     rs = float(g.rs) if g.rs is not None else ((VREF - float(g.vrl)) * RL) / max(0.001, float(g.vrl))
     r0 = float(g.r0) if g.r0 is not None else rs
     ratio = rs / max(1e-6, r0)
 
-    data = {
+    return {
         "vrl": round(float(g.vrl), 3) if g.vrl is not None else None,
         "rs": round(rs, 1),
         "r0": round(r0, 1),
         "ratio": round(ratio, 3),
-        "ppm": {
-            "co2":     round(_ppm_from_ratio(ratio, 116.6021, -2.7690), 1),
-            "nh3":     round(_ppm_from_ratio(ratio, 102.6940, -2.4880), 1),
-            "benzene": round(_ppm_from_ratio(ratio, 76.63,   -2.1680), 1),
-            "alcohol": round(_ppm_from_ratio(ratio, 77.255,  -3.18),   1),
-        },
+        "ppm": _ppm_from_ratio(ratio),
     }
 
+@app.post("/gas")
+async def gas(g: GasReading):
+    """
+    Accept gas info from ESP32/UNO (or the manual UI),
+    compute Rs/ratio/ppm, update LAST, and persist to DB.
+    """
+    data = _compute_gas(g)
+    if data is None:
+        return {"error": "Send at least one of: vrl, adc, or rs."}
+
     LAST["gas"] = data
-    LAST["gas_updated"] = datetime.utcnow().isoformat()
-    save_reading(data["ppm"])
+    LAST["gas_updated"] = _now_us()
+    save_reading(data["ppm"], LAST["gas_updated"])
+    notify_update()
     return {"ok": True, "data": data}
 
+class GasBatch(BaseModel):
+    readings: list[GasReading]
+
+@app.post("/gas/bulk")
+async def gas_bulk(batch: GasBatch):
+    """
+    Same as /gas for a burst of buffered readings (oldest first);
+    the rows are committed together in one transaction.
+    """
+    results = []
+    for i, g in enumerate(batch.readings):
+        data = _compute_gas(g)
+        if data is None:
+            return {"error": f"Reading {i}: send at least one of: vrl, adc, or rs."}
+        results.append(data)
+    if not results:
+        return {"error": "No readings sent."}
+
+    LAST["gas"] = results[-1]
+    LAST["gas_updated"] = _now_us()
+    save_readings([data["ppm"] for data in results], LAST["gas_updated"])
+    notify_update()
+    return {"ok": True, "saved": len(results), "data": results[-1]}
+
 @app.post("/cron/snapshot")
-def cron_snapshot():
+async def cron_snapshot():
     if not LAST.get("gas") or not LAST["gas"].get("ppm"):
         return {"ok": False, "error": "No gas reading to snapshot yet."}
     save_reading(LAST["gas"]["ppm"])
     return {"ok": True, "saved": LAST["gas"]["ppm"]}
 
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
+
+@app.post("/cron/prune")
+def cron_prune():
+    """Drop readings past the retention window (call e.g. nightly)."""
+    deleted = prune_readings(RETENTION_DAYS)
+    return {"ok": True, "deleted": deleted, "retention_days": RETENTION_DAYS}
+
 @app.get("/history")
-def history():
-    return {"history": load_history_last_days(days=2)}
+def history(request: Request, since: str | None = None):
+    """
+    Last 2 days of readings. With ?since=<time of the newest row the client
+    has>, only newer rows are returned. Full fetches carry an ETag built
+    from the oldest and newest row in the window, so it changes both when
+    rows arrive and when they age out, and If-None-Match answers 304.
+    Both key on ts, which is only exact with one worker: its writer commits
+    rows in ts order. With several workers a row can commit after a newer
+    one from another process and be skipped by both.
+    """
+    if since is not None:
+        try:
+            after = _iso_to_us(since)
+        except (TypeError, ValueError):
+            return {"error": "since must be an ISO timestamp as returned in 'time'."}
+        return {"history": load_history_last_days(days=2, after=after)}
+
+    oldest, newest = history_bounds(days=2)
+    headers = {"ETag": f'"{oldest or 0}-{newest or 0}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse({"history": load_history_last_days(days=2)}, headers=headers)
 
 # ------------------ Summary (vision + gas) ------------------
+_ROTTEN_RE = re.compile("rotten", re.IGNORECASE)
+
 def _summarize(last: dict) -> dict:
-    pred = extract_top_detection(last.get("vision"))
+    pred = last.get("vision_top")
 
     gas = (last.get("gas") or {}).get("ppm", {})
     co2  = gas.get("co2")
@@ -236,7 +727,7 @@ def _summarize(last: dict) -> dict:
     voc_hi = (benz or 0) >= 5 or (alco or 0) >= 10
 
     # Treat any detection whose class contains 'rotten' as spoiled
-    model_rotten = bool(pred and isinstance(pred.get("label"), str) and ("rotten" in pred["label"].lower()))
+    model_rotten = bool(pred and isinstance(pred.get("label"), str) and _ROTTEN_RE.search(pred["label"]))
     spoiled = model_rotten or co2_hi or nh3_hi or voc_hi
 
     return {
@@ -246,355 +737,130 @@ def _summarize(last: dict) -> dict:
         "decision": "SPOILED" if spoiled else "FRESH",
     }
 
+_CSV_BATCH_ROWS = 500
+
+def _csv_field(v) -> str:
+    return "" if v is None else str(v)
+
 @app.get("/export.csv")
 def export_csv():
-    rows = load_history_last_days(days=2)
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["timestamp_utc", "co2_ppm", "nh3_ppm", "benzene_ppm", "alcohol_eq"])
-    for r in rows:
-        ts = r["time"]
-        ppm = r["ppm"] or {}
-        w.writerow([ts, ppm.get("co2"), ppm.get("nh3"), ppm.get("benzene"), ppm.get("alcohol")])
-    csv_data = buf.getvalue()
-    return HTMLResponse(
-        content=csv_data,
+    def rows():
+        cur = _history_cursor(days=2)
+        try:
+            yield "timestamp_utc,co2_ppm,nh3_ppm,benzene_ppm,alcohol_eq\r\n"
+            # Timestamps and numbers never need CSV quoting. One chunk per
+            # fetchmany() batch keeps memory flat without a thread hop per row.
+            while batch := cur.fetchmany(_CSV_BATCH_ROWS):
+                yield "".join(
+                    _ts_iso(ts) + "," + ",".join(map(_csv_field, ppm)) + "\r\n"
+                    for (ts, *ppm) in batch
+                )
+        finally:
+            cur.close()
+
+    return StreamingResponse(
+        rows(),
         media_type="text/csv",
         headers={"Content-Disposition": 'attachment; filename="gas_last_2_days.csv"'}
     )
 
-@app.get("/summary")
-def summary():
-    return _summarize(LAST)
-
-# ------------------ UI ------------------
-@app.get("/", response_class=HTMLResponse)
-def welcome():
-    return """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8">
-  <title>Welcome • Fruit Detector</title>
-  <style>
-    body{
-      margin:0; font-family:Inter,Arial,Helvetica,sans-serif; color:#fff; min-height:100vh;
-      background:url('https://i.pinimg.com/originals/30/ab/43/30ab43926be6852d3b03572459ab847d.gif') center/cover no-repeat fixed;
-      display:flex; align-items:center; justify-content:center;
-    }
-    body::before{content:""; position:fixed; inset:0; background:linear-gradient(to bottom right,rgba(0,0,0,.35),rgba(0,0,0,.55)); pointer-events:none;}
-    .wrap{
-      position:relative; text-align:center; padding:48px 40px; max-width:900px; width:92%;
-      background:rgba(0,0,0,.30); border:1px solid rgba(255,255,255,.15); border-radius:20px; box-shadow:0 20px 60px rgba(0,0,0,.45);
-      backdrop-filter:blur(6px); -webkit-backdrop-filter:blur(6px);
-    }
-    h1{font-size:clamp(2rem,4vw,3rem); margin:0 0 12px; letter-spacing:.5px;}
-    p{font-size:1.05rem; opacity:.95; margin:0 auto 22px; max-width:760px; line-height:1.6}
-    .cta{
-      display:inline-block; margin-top:8px; padding:14px 26px; font-weight:800; letter-spacing:.2px; color:#0b3d2e;
-      background:linear-gradient(135deg,#7CFFCB,#4ADE80); border:none; border-radius:12px; text-decoration:none;
-      box-shadow:0 8px 24px rgba(16,185,129,.35); transition:transform .15s, box-shadow .15s, opacity .15s;
-    }
-    .cta:hover{transform:translateY(-2px); box-shadow:0 12px 28px rgba(16,185,129,.45);}
-    .badge{
-      display:inline-flex; gap:8px; padding:8px 12px; border-radius:999px; font-weight:700; color:#0b3d2e; background:rgba(255,255,255,.9);
-      box-shadow:inset 0 0 0 1px rgba(0,0,0,.06); margin-bottom:14px
-    }
-  </style>
-</head>
-<body>
-  <div class="wrap">
-    <div class="badge">🍎 <span>Fruit Freshness & Gas Detector</span></div>
-    <h1>Smarter Food, Fresher Choices</h1>
-    <p>Check fruit freshness with AI and estimate air quality using your sensor readings.</p>
-    <a class="cta" href="/app">Start Detecting Freshness</a>
-    <div class="meta">Or explore the API docs at <code>/docs</code>.</div>
-  </div>
-</body>
-</html>
-    """
-
-@app.get("/app", response_class=HTMLResponse)
-def ui():
-    return """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-  <meta charset="UTF-8" />
-  <title>Fruit Freshness Detector</title>
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.4/dist/chart.umd.min.js"></script>
-  <style>
-    :root{ --green:#22c55e; --green-dark:#16a34a; --blue:#0ea5e9; --amber:#f59e0b;
-           --red:#ef4444; --slate:#1f2937; --glass-bg: rgba(255,255,255,.86);
-           --glass-border: rgba(0,0,0,.06); --shadow: 0 10px 30px rgba(0,0,0,.18); }
-    body{ margin:0; font-family:Inter,system-ui,Arial,Helvetica,sans-serif; color:var(--slate);
-          background:url('https://i.pinimg.com/originals/3d/91/51/3d9151870044e69f2d93a9d0311275dd.gif') center/cover no-repeat fixed; min-height:100vh }
-    body::before{content:""; position:fixed; inset:0; background:linear-gradient(180deg,rgba(0,0,0,.32),rgba(0,0,0,.22)); pointer-events:none; z-index:-1}
-    header{ background:linear-gradient(90deg, rgba(34,197,94,.97), rgba(22,163,74,.97));
-            padding:18px 16px; text-align:center; color:#fff; box-shadow:var(--shadow); position:sticky; top:0; z-index:10; backdrop-filter: blur(4px); }
-    header h1{ margin:0; font-size:clamp(1.3rem,2.8vw,1.9rem); letter-spacing:.3px }
-    header p{ margin:6px 0 0 0; opacity:.95 }
-    .container{ width:92%; max-width:1100px; margin:24px auto; display:grid; gap:18px }
-    .card{ background:var(--glass-bg); border-radius:16px; padding:18px; box-shadow:var(--shadow);
-           border:1px solid var(--glass-border); backdrop-filter: blur(6px); transition: transform .15s ease, box-shadow .2s ease; }
-    .card:hover{ transform:translateY(-1px); box-shadow: 0 12px 34px rgba(0,0,0,.22); }
-    .card h2{ margin:0 0 12px; color:var(--green-dark); font-size:1.15rem; border-left:4px solid var(--green-dark); padding-left:10px }
-    button{ background:var(--green); color:#fff; padding:10px 14px; border:none; border-radius:10px;
-            cursor:pointer; font-weight:800; letter-spacing:.2px; box-shadow: 0 5px 18px rgba(34,197,94,.35);
-            display:inline-flex; align-items:center; gap:8px; transition: background .15s ease, transform .1s ease; }
-    button:hover{ background:var(--green-dark) } button:active{ transform:translateY(1px) }
-    button.secondary{ background:#e7fff1; color:#0b3d2e; border:1px solid #b9f3d2; box-shadow:none; }
-    button.gray{ background:#f3f4f6; color:#111827; border:1px solid #e5e7eb; box-shadow:none; }
-    input[type=file], input[type=number]{ padding:10px 12px; border:1px solid #d1d5db; border-radius:10px; background:#fff; font-weight:600;
-                                          outline:none; transition:border-color .15s ease, box-shadow .15s ease; }
-    input[type=file]:focus, input[type=number]:focus{ border-color: var(--green); box-shadow: 0 0 0 3px rgba(34,197,94,.18); }
-    .row{ display:flex; gap:10px; flex-wrap:wrap; align-items:center }
-    .pill{ padding:6px 10px; border-radius:999px; font-weight:700; font-size:.9rem; border:1px solid #d1d5db; background:#fff }
-    .ok{ background:#ecfdf5; color:#065f46; border:1px solid #a7f3d0 } .bad{ background:#fef2f2; color:#991b1b; border:1px solid #fecaca }
-    .warn{ background:#fffbeb; color:#92400e; border:1px solid #fde68a } .big{ font-size:22px; font-weight:900; margin-top:10px }
-    img,video,canvas{ max-width:100%; border-radius:12px; margin-top:10px } #preview{ display:none; }
-    pre{ white-space:pre-wrap; background:#0b1220; color:#e5e7eb; border-radius:12px; padding:12px; max-height:320px; overflow:auto;
-         border:1px solid rgba(255,255,255,.05); }
-    footer{ text-align:center; padding:16px; background:rgba(238,238,238,.92); color:#111827; margin-top:10px; font-size:.9rem; border-top:1px solid rgba(0,0,0,.06) }
-    .chart-wrap{ position:relative; height:280px; width:100%; overflow:hidden; border-radius:12px; background:#ffffffe6; border:1px solid rgba(0,0,0,.06) }
-    .chart-empty{ position:absolute; inset:0; display:flex; align-items:center; justify-content:center; color:#6b7280; font-size:.95rem; pointer-events:none; font-weight:700; }
-    .toast{ position:fixed; right:14px; bottom:14px; background:rgba(17,24,39,.92); color:#fff; padding:10px 14px; border-radius:10px; font-weight:700;
-            box-shadow: var(--shadow); transform: translateY(10px); opacity:0; transition: all .2s ease; z-index:30; }
-    .toast.show{ transform: translateY(0); opacity:1; } .status{ font-size:.9rem; opacity:.85; display:inline-flex; align-items:center; gap:8px; margin-left:8px; }
-    .dot{ width:8px; height:8px; border-radius:50%; background:#22c55e } .muted{ opacity:.7 }
-  </style>
-</head>
-<body>
-  <header>
-    <h1>🍎 Fruit Freshness & Gas Detector</h1>
-    <p>Upload, predict, and view gas-based decision</p>
-  </header>
-
-  <div class="container">
-
-    <div class="card">
-      <h2>1) Upload or Capture Fruit Image <span id="visionStatus" class="status muted"><span class="dot"></span> idle</span></h2>
-      <div class="row">
-        <input id="file" type="file" accept="image/*" />
-        <button type="button" onclick="predictFile()">🔮 Predict</button>
-        <button type="button" class="secondary" onclick="startCam()">📷 Use Webcam</button>
-        <button type="button" class="gray" onclick="snap()">📸 Snapshot</button>
-        <button type="button" class="gray" onclick="stopCam()">⏹ Stop Camera</button>
-        <button type="button" class="gray" onclick="clearVision()">🧹 Clear Image</button>
-      </div>
-      <video id="video" autoplay playsinline width="320" height="240" style="display:none;background:#000"></video>
-      <canvas id="canvas" width="320" height="240" style="display:none"></canvas>
-      <img id="preview" alt="preview" />
-      <div id="visionTop" class="big"></div>
-      <span id="visionBadge" class="pill" style="display:none"></span>
-    </div>
-
-    <div class="card">
-      <h2>2) Gas Sensor Reading <span id="gasStatus" class="status muted"><span class="dot" style="background:#0ea5e9"></span> idle</span></h2>
-      <div class="row" style="margin-bottom:8px">
-        ADC <input id="adc" type="number" value="1800" autocomplete="off" />
-        Vref <input id="vref" type="number" value="3.3" step="0.1" autocomplete="off" />
-        RL(Ω) <input id="rl" type="number" value="10000" autocomplete="off" />
-        R0(Ω) <input id="r0" type="number" value="10000" autocomplete="off" />
-        <button type="button" onclick="sendGas()">📤 Send</button>
-        <button type="button" class="gray" onclick="preset('fresh')">🍏 Fresh Preset</button>
-        <button type="button" class="gray" onclick="preset('spoiled')">🍌 Spoiled Preset</button>
-        <button type="button" class="gray" onclick="resetGas()">🔁 Reset</button>
-        <button type="button" class="gray" onclick="saveSnap()">💾 Save Snapshot</button>
-      </div>
-      <div id="gasBadges" style="margin-top:6px"></div>
-    </div>
-
-    <div class="card">
-      <h2>3) Final Decision</h2>
-      <div id="decision" class="big"></div>
-      <div class="row" style="margin:10px 0">
-        <button type="button" class="secondary" onclick="refresh()">🔄 Refresh Summary</button>
-        <button type="button" class="gray" onclick="clearAll()">🧹 Clear All</button>
-      </div>
-      <pre id="raw"></pre>
-    </div>
-
-    <div class="card">
-      <h2>4) Gas Chart (Last 2 Days)</h2>
-      <div class="chart-wrap">
-        <canvas id="gasChart"></canvas>
-        <div id="chartEmpty" class="chart-empty">No readings yet — send gas data or save a snapshot.</div>
-      </div>
-    </div>
-
-  </div>
-
-  <footer>© 2025 Fruit Detector • FastAPI + Detect + MQ-135</footer>
-  <div id="toast" class="toast">Saved ✔</div>
-
-<script>
-"use strict";
-const $ = (id) => document.getElementById(id);
-const el = {
-  file:$('file'), preview:$('preview'), video:$('video'), canvas:$('canvas'),
-  visionBadge:$('visionBadge'), visionTop:$('visionTop'),
-  gasBadges:$('gasBadges'), decision:$('decision'), raw:$('raw'),
-  visionStatus:$('visionStatus'), gasStatus:$('gasStatus'),
-  toast:$('toast'), chartEmpty:$('chartEmpty'), gasChart:$('gasChart'),
-  adc:$('adc'), vref:$('vref'), rl:$('rl'), r0:$('r0'),
-};
-const badge = (t, c) => `<span class="pill ${c}">${t}</span>`;
-const GAS_LS_KEY = "gas_history_cache_v1";
-
-function toast(msg){ el.toast.textContent = msg || 'Done'; el.toast.classList.add('show'); setTimeout(()=> el.toast.classList.remove('show'), 1500); }
-function clearVision(){ el.preview.src=''; el.preview.style.display='none'; el.video.style.display='none'; el.canvas.style.display='none'; el.visionBadge.style.display='none'; el.visionTop.textContent=''; }
-function clearAll(){ clearVision(); el.gasBadges.innerHTML=''; el.decision.className='big'; el.decision.textContent=''; el.raw.textContent=''; }
-function setStatus(which, state){
-  const statusEl = (which === 'vision') ? el.visionStatus : el.gasStatus;
-  if(!statusEl) return;
-  const color = (which === 'vision') ? '#22c55e' : '#0ea5e9';
-  if(state === 'busy'){ statusEl.classList.remove('muted'); statusEl.innerHTML = `<span class="dot" style="background:${color}"></span> working…`; }
-  else { statusEl.classList.add('muted'); statusEl.innerHTML = `<span class="dot" style="background:${color}"></span> idle`; }
-}
-
-function updateVisionFromRaw(j){
-  if (Array.isArray(j?.predictions) && j.predictions.length){
-    const pred = [...j.predictions].sort((a,b)=>(b.confidence||0)-(a.confidence||0))[0];
-    const lbl = String(pred.class || '?');
-    const conf = Number((pred.confidence||0)*100).toFixed(1);
-    el.visionBadge.style.display = 'inline-block';
-    const bad = /(^|_|\b)rotten/i.test(lbl);
-    el.visionBadge.className = 'pill ' + (bad ? 'bad' : 'ok');
-    el.visionBadge.textContent = `${lbl} • ${conf}%`;
-    el.visionTop.textContent = lbl.replace(/_/g,' ').toUpperCase();
-  }
-}
-
-async function predictFile(){
-  const f = el.file.files[0];
-  if (!f) { alert('Choose an image'); return; }
-  el.preview.src = URL.createObjectURL(f); el.preview.style.display = 'block';
-  const fd = new FormData(); fd.append('image', f, f.name);
-  setStatus('vision','busy');
-  try {
-    const r = await fetch('/predict', { method:'POST', body:fd });
-    let j = null; try { j = await r.json(); } catch (_) { j = {error:'Bad JSON from server'}; }
-    if (!r.ok || j?.error){ alert('Predict failed: ' + (j?.error || r.statusText)); return; }
-    updateVisionFromRaw(j); await refresh();
-  } finally { setStatus('vision','idle'); }
-}
+# Recomputed only when vision or gas data changes (keyed on update markers).
+# Only touched from the event loop, like LAST, so key and value stay paired.
+_SUMMARY_CACHE = {"key": None, "value": None}
 
-let stream = null;
-async function startCam(){ try{ stream = await navigator.mediaDevices.getUserMedia({video:true}); el.video.srcObject = stream; el.video.style.display='block'; }catch(e){ alert('Camera error: '+e); } }
-function stopCam(){ if(stream){ stream.getTracks().forEach(t=>t.stop()); stream=null; } el.video.style.display='none'; }
-function snap(){
-  if (!stream) { alert('Start the webcam first'); return; }
-  const ctx = el.canvas.getContext('2d'); el.canvas.style.display='block';
-  ctx.drawImage(el.video, 0, 0, el.canvas.width, el.canvas.height);
-  el.canvas.toBlob(async (b) => {
-    const fd = new FormData(); fd.append('image', b, 'snapshot.jpg');
-    setStatus('vision','busy');
-    try {
-      const r = await fetch('/predict', { method:'POST', body:fd });
-      let j = null; try { j = await r.json(); } catch (_) { j = {error:'Bad JSON from server'}; }
-      if (!r.ok || j?.error){ alert('Predict failed: ' + (j?.error || r.statusText)); return; }
-      updateVisionFromRaw(j); await refresh();
-    } finally { setStatus('vision','idle'); }
-  }, 'image/jpeg', 0.92);
-}
+def _current_summary() -> dict:
+    key = (LAST["vision_updated"], LAST["gas_updated"])
+    if key != _SUMMARY_CACHE["key"]:
+        _SUMMARY_CACHE["value"] = _summarize(LAST)
+        _SUMMARY_CACHE["key"] = key
+    return _SUMMARY_CACHE["value"]
 
-/* Gas */
-async function sendGas(){
-  const body = {
-    adc: parseInt(el.adc.value || '0'),
-    vref: parseFloat(el.vref.value || '3.3'),
-    rl: parseInt(el.rl.value || '10000'),
-    r0: parseInt(el.r0.value || '10000'),
-    adc_max: 4095
-  };
-  setStatus('gas','busy');
-  try{
-    const r = await fetch('/gas', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(body) });
-    if(!r.ok){ const t = await r.text(); alert('Gas send failed: ' + (t || r.statusText)); return; }
-    await refresh(); await loadChart(true);
-  }finally{ setStatus('gas','idle'); }
-}
-function resetGas(){ el.adc.value="1800"; el.vref.value="3.3"; el.rl.value="10000"; el.r0.value="10000"; }
-function preset(type){ if(type==='fresh'){ el.adc.value="700"; el.r0.value="12000"; } if(type==='spoiled'){ el.adc.value="2500"; el.r0.value="8000"; } }
-async function saveSnap(){ const r = await fetch('/cron/snapshot', {method:'POST'}); const j = await r.json(); if(j.ok){ await loadChart(true); toast('Snapshot saved ✔'); } else { alert('No reading to save yet.'); } }
-
-/* Summary */
-async function refresh(){
-  const r = await fetch('/summary', {cache:'no-store'}); const s = await r.json();
-  if (s.vision && s.vision.label){
-    el.visionBadge.style.display='inline-block';
-    const lbl = String(s.vision.label);
-    const conf = Number(s.vision.confidence ?? 0).toFixed(1);
-    const bad = /(^|_|\b)rotten/i.test(lbl);
-    el.visionBadge.className = 'pill ' + (bad ? 'bad' : 'ok');
-    el.visionBadge.textContent = `${lbl} • ${conf}%`;
-    el.visionTop.textContent = lbl.replace(/_/g,' ').toUpperCase();
-  } else { el.visionBadge.style.display='none'; el.visionTop.textContent=''; }
-
-  const g  = s.gas_ppm || {}, gf = s.gas_flags || {};
-  el.gasBadges.innerHTML = [
-    badge(`CO₂ ${g.co2??'—'} ppm`, gf.co2_high ? 'bad' : 'ok'),
-    badge(`NH₃ ${g.nh3??'—'} ppm`, gf.nh3_high ? 'bad' : 'ok'),
-    badge(`VOC ${g.alcohol??'—'} eq`, gf.voc_high ? 'warn' : 'ok')
-  ].join(' ');
-
-  el.decision.className = 'big ' + (s.decision === 'SPOILED' ? 'bad' : 'ok');
-  el.decision.textContent = s.decision || '';
-  el.raw.textContent = JSON.stringify(s, null, 2);
-}
-refresh(); setInterval(refresh, 2000);
-
-/* Chart */
-let gasChart = null;
-function saveCache(rows){ try{ localStorage.setItem("gas_history_cache_v1", JSON.stringify(rows.slice(-300))); }catch(_){} }
-function loadCache(){ try{ return JSON.parse(localStorage.getItem("gas_history_cache_v1") || "[]"); }catch(_){ return []; } }
-function buildGradient(ctx, color){ const g = ctx.createLinearGradient(0,0,0,ctx.canvas.height); g.addColorStop(0,color+"AA"); g.addColorStop(1,color+"00"); return g; }
-async function loadChart(forceFetch=false){
-  const canvas = el.gasChart; if(!canvas) return;
-  const ctx = canvas.getContext('2d'); if(!ctx) return;
-  let rows = [];
-  if (!forceFetch){ rows = loadCache(); setTimeout(()=>loadChart(true), 100); }
-  else{
-    try{ const r = await fetch('/history', {cache:"no-store"}); const j = await r.json(); if(Array.isArray(j.history)) rows = j.history; }catch(_){}
-  }
-  if (!rows.length) rows = loadCache();
-  const labels = rows.map(h => new Date(h.time || h.ts).toLocaleString());
-  const co2 = rows.map(h => h?.ppm?.co2 ?? null);
-  const nh3 = rows.map(h => h?.ppm?.nh3 ?? null);
-  const benz = rows.map(h => h?.ppm?.benzene ?? null);
-  el.chartEmpty.style.display = rows.length ? "none" : "flex";
-  if(rows.length) saveCache(rows);
-  const COL = { co2:"#22c55e", nh3:"#0ea5e9", benz:"#f59e0b" };
-  const ds = [
-    { label:"CO₂ (ppm)", data:co2, tension:.35, borderColor:COL.co2, pointRadius:0, hitRadius:12, fill:true, backgroundColor:buildGradient(ctx, COL.co2) },
-    { label:"NH₃ (ppm)", data:nh3, tension:.35, borderColor:COL.nh3, pointRadius:0, hitRadius:12, fill:true, backgroundColor:buildGradient(ctx, COL.nh3) },
-    { label:"Benzene (ppm)", data:benz, tension:.35, borderColor:COL.benz, pointRadius:0, hitRadius:12, fill:true, backgroundColor:buildGradient(ctx, COL.benz) }
-  ];
-  const options = {
-    responsive:true, maintainAspectRatio:false,
-    interaction:{ mode:"index", intersect:false },
-    plugins:{ legend:{ position:"bottom", labels:{ boxWidth:12, font:{weight:700} } },
-              tooltip:{ backgroundColor:"rgba(0,0,0,.85)", titleFont:{weight:800} } },
-    scales:{ x:{ ticks:{ autoSkip:true, maxTicksLimit:8 }, grid:{ display:false } },
-             y:{ beginAtZero:true, grid:{ color:"rgba(0,0,0,.06)" } } },
-    animation:{ duration: 350 }
-  };
-  if (!gasChart){
-    canvas.style.height = "280px";
-    gasChart = new Chart(ctx, { type:"line", data:{ labels, datasets: ds }, options });
-  }else{
-    gasChart.data.labels = labels;
-    gasChart.data.datasets[0].data = co2;
-    gasChart.data.datasets[1].data = nh3;
-    gasChart.data.datasets[2].data = benz;
-    gasChart.update();
-  }
-}
-loadChart(false); setInterval(()=>loadChart(true), 60_000);
-</script>
+@app.get("/summary")
+async def summary():
+    return _current_summary()
+
+# ------------------ Live updates (SSE) ------------------
+# /events subscribers wait on the current asyncio.Event; each update sets it
+# and swaps in a fresh one for the next change.
+SSE_KEEPALIVE_SECONDS = 15
+# Each stream ends after this long and EventSource reconnects SSE_RETRY_MS
+# later. Keeps it under gunicorn's --graceful-timeout, so a worker shutting
+# down is not blocked by open /app tabs and its lifespan cleanup still runs.
+SSE_MAX_SECONDS = 25
+SSE_RETRY_MS = 1000
+_UPDATES = {"loop": None, "event": None}
+
+def init_updates():
+    _UPDATES["loop"] = asyncio.get_running_loop()
+    _UPDATES["event"] = asyncio.Event()
+
+def _wake_subscribers():
+    _UPDATES["event"].set()
+    _UPDATES["event"] = asyncio.Event()
+
+def notify_update():
+    """Wake /events subscribers. Safe to call from threadpool handlers."""
+    loop = _UPDATES["loop"]
+    if loop is not None:
+        loop.call_soon_threadsafe(_wake_subscribers)
+
+def _sse(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+@app.get("/events")
+async def events():
+    async def stream():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SSE_MAX_SECONDS
+        event = _UPDATES["event"]
+        summary, history = _current_summary(), LAST["history_updated"]
+        yield b"retry: %d\n" % SSE_RETRY_MS + _sse(summary)
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                await asyncio.wait_for(event.wait(), min(SSE_KEEPALIVE_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                # Comment line keeps proxies from closing an idle stream
+                yield b": keep-alive\n\n"
+                continue
+            event = _UPDATES["event"]
+            # _current_summary() returns the same object until LAST changes
+            if (latest := _current_summary()) is not summary:
+                summary = latest
+                yield _sse(summary)
+            if LAST["history_updated"] != history:
+                history = LAST["history_updated"]
+                yield b"event: history\n" + _sse({"time": _ts_iso(history)})
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-</body>
-</html>
-    """
+# ------------------ UI ------------------
+# Pages live in static/ and are read, encoded and hashed once at import
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+def _html_page(name: str) -> tuple[bytes, str]:
+    """Load a page from STATIC_DIR once and derive its ETag."""
+    body = (STATIC_DIR / name).read_bytes()
+    return body, f'"{hashlib.md5(body).hexdigest()}"'
+
+def _serve_page(request: Request, page: tuple[bytes, str]) -> Response:
+    body, etag = page
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="text/html", headers=headers)
+
+_WELCOME_PAGE = _html_page("index.html")
+_APP_PAGE = _html_page("app.html")
+
+@app.get("/", response_class=Response)
+def welcome(request: Request):
+    return _serve_page(request, _WELCOME_PAGE)
+
+@app.get("/app", response_class=Response)
+def ui(request: Request):
+    return _serve_page(request, _APP_PAGE)